@@ -1,61 +1,117 @@
 import io
+import os
 import re
+import copy
 import zipfile
 import shutil
 import tempfile
 import platform
+import hashlib
+import functools
+import threading
 import subprocess
 import unicodedata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from zipfile import ZipFile
 from pathlib import Path
+from xml.sax.saxutils import escape as xml_escape
 
 import streamlit as st
 import pandas as pd
+import openpyxl
 from docxtpl import DocxTemplate
 
 # ===================== Utilidades =====================
 
+# Tabla para los acentos que de verdad aparecen en encabezados en español:
+# str.translate es ~5-10× más rápido que el pase NFKD + generador
+_ACCENTS_TBL = str.maketrans("áéíóúüñÁÉÍÓÚÜÑ", "AEIOUUNAEIOUUN")
+
+# Se normalizan los mismos strings miles de veces (encabezados, placeholders);
+# el lru_cache convierte la normalización en un lookup de dict.
+@functools.lru_cache(maxsize=4096)
 def strip_accents_upper(s: str) -> str:
+    out = s.translate(_ACCENTS_TBL).upper()
+    if out.isascii():
+        return out
+    # Caracteres fuera de la tabla: pase NFKD completo como antes
     s = unicodedata.normalize("NFKD", s)
     s = "".join(c for c in s if not unicodedata.combining(c))
     return s.upper()
 
+@functools.lru_cache(maxsize=4096)
+def _normalize_key_cached(s: str) -> str:
+    s = s.strip().replace("\n", " ")
+    s = re.sub(r"\s+", " ", s)
+    return strip_accents_upper(s)
+
 def normalize_key(s: str) -> str:
     if s is None:
         return ""
-    s = str(s).strip().replace("\n", " ")
-    s = re.sub(r"\s+", " ", s)
-    return strip_accents_upper(s)
+    return _normalize_key_cached(str(s))
 
-def sanitize_filename(name: str) -> str:
-    name = re.sub(r'[<>:"/\\|?*\x00-\x1F]', "_", str(name))
-    name = name.strip().strip(".")
-    return (name or "documento")[:200]
+def sanitize_filenames(series) -> list:
+    """Nombres de archivo seguros para la columna completa.
 
-def can_convert_pdf() -> bool:
-    """¿Hay docx2pdf (Word) o LibreOffice disponibles para convertir a PDF?"""
+    Un pase en C de pandas sobre todo el lote en lugar de despachar regex
+    fila por fila; las celdas vacías caen a 'documento_<n>'."""
+    clean = (series.astype(str)
+             .str.replace(r'[<>:"/\\|?*\x00-\x1F]', "_", regex=True)
+             .str.strip().str.strip(".").str.slice(0, 200))
+    return [c or f"documento_{i+1}" for i, c in enumerate(clean)]
+
+def _has_docx2pdf() -> bool:
     try:
         from docx2pdf import convert  # noqa: F401
         return True
     except Exception:
-        pass
-    soffice = shutil.which("soffice") or shutil.which("libreoffice")
-    return bool(soffice)
+        return False
+
+# Backend de PDF detectado UNA vez al importar: antes cada archivo intentaba
+# docx2pdf, fallaba en Linux (sin Word) y caía a soffice vía excepción.
+# docx2pdf solo funciona de verdad donde hay Word (Windows/Mac).
+_SOFFICE = shutil.which("soffice") or shutil.which("libreoffice")
+if platform.system() in ("Windows", "Darwin") and _has_docx2pdf():
+    _PDF_BACKEND = "docx2pdf"
+elif _SOFFICE:
+    _PDF_BACKEND = "soffice"
+else:
+    _PDF_BACKEND = None
+
+def can_convert_pdf() -> bool:
+    """¿Hay docx2pdf (Word) o LibreOffice disponibles para convertir a PDF?"""
+    return _PDF_BACKEND is not None
+
+_LO_PROFILE = None
+
+def _soffice_profile_args() -> list:
+    """Perfil de usuario de soffice persistente durante la sesión.
+
+    Crear el perfil desde cero es buena parte del arranque de LibreOffice;
+    reutilizarlo entre invocaciones y lotes paga ese costo una sola vez.
+    (Un servidor UNO residente sería aún mejor, pero los bindings `uno`
+    solo vienen con el Python propio de LibreOffice, no por pip.)"""
+    global _LO_PROFILE
+    if _LO_PROFILE is None:
+        _LO_PROFILE = tempfile.mkdtemp(prefix="lo_profile_")
+    return [f"-env:UserInstallation=file://{_LO_PROFILE}"]
 
 def try_docx_to_pdf(input_docx: Path, output_pdf: Path) -> bool:
-    """Convierte DOCX→PDF con docx2pdf (Word) o LibreOffice (si están disponibles)."""
-    try:
-        from docx2pdf import convert as docx2pdf_convert
-        docx2pdf_convert(str(input_docx), str(output_pdf))
-        return output_pdf.exists()
-    except Exception:
-        pass
+    """Convierte DOCX→PDF con el backend detectado (Word o LibreOffice)."""
+    if _PDF_BACKEND == "docx2pdf":
+        try:
+            from docx2pdf import convert as docx2pdf_convert
+            docx2pdf_convert(str(input_docx), str(output_pdf))
+            return output_pdf.exists()
+        except Exception:
+            return False
 
-    soffice = shutil.which("soffice") or shutil.which("libreoffice")
-    if soffice:
+    if _PDF_BACKEND == "soffice":
         try:
             outdir = output_pdf.parent
-            cmd = [soffice, "--headless", "--convert-to", "pdf", "--outdir", str(outdir), str(input_docx)]
+            cmd = [_SOFFICE, "--headless", *_soffice_profile_args(),
+                   "--convert-to", "pdf", "--outdir", str(outdir), str(input_docx)]
             subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             gen_file = input_docx.with_suffix(".pdf")
             gen_file_out = outdir / gen_file.name
@@ -68,31 +124,379 @@ def try_docx_to_pdf(input_docx: Path, output_pdf: Path) -> bool:
 
     return False
 
-def render_docx_from_template(template_bytes: bytes, context: dict) -> bytes:
-    tpl = DocxTemplate(io.BytesIO(template_bytes))
-    tpl.render(context)
+def try_docx_to_pdf_batch(docx_paths: list, outdir: Path) -> list:
+    """Convierte muchos DOCX→PDF en UNA sola invocación de LibreOffice.
+
+    Arrancar soffice cuesta ~1-3 s por proceso y domina sobre la conversión
+    real; pasarle todos los archivos de una vez paga ese costo una sola vez.
+    Devuelve la lista de PDFs generados. Sin soffice (o si la invocación en
+    lote falla) cae al camino archivo-por-archivo.
+
+    Con muchos archivos el lote se parte en hasta 8 shards convertidos por
+    procesos soffice concurrentes (hilos: el trabajo real vive en el
+    subproceso, que libera el GIL). Cada shard lleva su propio perfil
+    porque soffice bloquea el perfil a una sola instancia."""
+    if _PDF_BACKEND == "soffice" and docx_paths:
+        n_shards = min(8, os.cpu_count() or 1, len(docx_paths))
+        if n_shards > 1 and len(docx_paths) >= MIN_ROWS_PARALLEL:
+            shards = [docx_paths[k::n_shards] for k in range(n_shards)]
+        else:
+            shards = [docx_paths]
+
+        def convert_shard(paths):
+            if len(shards) > 1:
+                # Perfil efímero DENTRO de outdir: se limpia junto con el
+                # TemporaryDirectory del lote en vez de acumularse en /tmp
+                profile_dir = tempfile.mkdtemp(prefix="lo_profile_", dir=outdir)
+                profile = [f"-env:UserInstallation=file://{profile_dir}"]
+            else:
+                profile = _soffice_profile_args()
+            cmd = [_SOFFICE, "--headless", *profile,
+                   "--convert-to", "pdf", "--outdir", str(outdir),
+                   *map(str, paths)]
+            try:
+                subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except Exception:
+                pass
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as ex:
+            list(ex.map(convert_shard, shards))
+
+        pdfs = [outdir / p.with_suffix(".pdf").name for p in docx_paths]
+        if any(p.exists() for p in pdfs):
+            return [p for p in pdfs if p.exists()]
+
+    pdf_paths = []
+    for docx_path in docx_paths:
+        pdf_path = docx_path.with_suffix(".pdf")
+        if try_docx_to_pdf(docx_path, pdf_path) and pdf_path.exists():
+            pdf_paths.append(pdf_path)
+    return pdf_paths
+
+TEXT_PART_RE = re.compile(r"^word/(document|header\d*|footer\d*)\.xml$")
+XML_TAG_RE = re.compile(r"<[^>]+>")
+# Nombre "pelado": letras/dígitos/_/espacios. Cualquier otra cosa
+# ({{ x|upper }}, {{ a.b }}, llamadas...) es Jinja y necesita docxtpl.
+BARE_PLACEHOLDER_RE = re.compile(r"[\w ]+$")
+
+def _template_fast_parts(template_bytes: bytes):
+    """Partes de texto del machote si admite sustitución directa, o None.
+
+    El camino rápido solo sirve si el machote usa placeholders planos
+    `{{Nombre}}`: sin lógica ni expresiones Jinja (`{% %}`, `{# #}`,
+    filtros/atributos dentro de `{{ }}`) y sin llaves partidas en varios
+    "runs" por Word. Se compara el conteo de matches del texto visible
+    contra el XML crudo (no solo el conjunto: una ocurrencia intacta no
+    puede tapar otra partida del mismo placeholder); si el texto visible
+    revela más de lo que el XML crudo trae completo, hace falta docxtpl
+    para fusionarlos.
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(template_bytes)) as z:
+            parts = {
+                n: z.read(n).decode("utf-8")
+                for n in z.namelist() if TEXT_PART_RE.match(n)
+            }
+    except Exception:
+        return None
+    for xml in parts.values():
+        visible = XML_TAG_RE.sub("", xml)
+        if "{%" in xml or "{%" in visible or "{#" in xml or "{#" in visible:
+            return None
+        raw_matches = sorted(PLACEHOLDER_RE.findall(xml))
+        if raw_matches != sorted(PLACEHOLDER_RE.findall(visible)):
+            return None
+        if any(not BARE_PLACEHOLDER_RE.fullmatch(m) for m in raw_matches):
+            return None
+    return parts
+
+def build_skeleton_zip(template_bytes: bytes, text_part_names) -> bytes:
+    """ZIP con las partes estáticas del machote (estilos, tema, imágenes...).
+
+    Se deflatea UNA vez; por fila solo se copia este bloque y se anexan
+    las partes de texto recién sustituidas, que son una fracción mínima
+    del tamaño total del DOCX.
+    """
     out = io.BytesIO()
-    tpl.save(out)
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zin, \
+         ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            if item.filename not in text_part_names:
+                zout.writestr(item, zin.read(item))
     return out.getvalue()
 
-# ============== Detección (best effort, opcional) ==============
+def render_docx_fast(skeleton_zip: bytes, fast_parts: dict, context: dict) -> memoryview:
+    """Sustituye `{{...}}` directo sobre el XML, sin pasar por docxtpl/lxml.
+
+    Devuelve un memoryview sobre el buffer interno (getvalue() duplicaría
+    todo el DOCX solo para pasarlo al ZIP de salida)."""
+    def repl(m):
+        return xml_escape(str(context.get(m.group(1).strip(), "")))
+
+    buf = io.BytesIO(skeleton_zip)
+    with ZipFile(buf, "a", compression=zipfile.ZIP_DEFLATED) as zout:
+        for name, xml in fast_parts.items():
+            zout.writestr(name, PLACEHOLDER_RE.sub(repl, xml))
+    return buf.getbuffer()
+
+def make_docx_renderer(template_bytes: bytes):
+    """Parsea el machote UNA sola vez y devuelve render(context) -> bytes.
+
+    DocxTemplate re-abre el zip y re-parsea el XML en cada construcción;
+    para N certificados eso multiplica el costo de parseo por N. Aquí se
+    parsea una vez y por fila solo se restaura una copia del documento.
+
+    Si el machote solo usa placeholders planos, se salta docxtpl por
+    completo y se sustituye directo sobre el XML (mucho más rápido).
+    Con lógica Jinja, las partes de texto se precompilan UNA vez como
+    plantillas Jinja sobre el XML ya "parchado" por docxtpl (que fusiona
+    los runs partidos por Word): por fila solo se renderiza el string y
+    se anexa al esqueleto, sin re-parsear lxml.
+    """
+    fast_parts = _template_fast_parts(template_bytes)
+    if fast_parts is not None:
+        skeleton_zip = build_skeleton_zip(template_bytes, fast_parts)
+
+        def render_fast(context: dict) -> memoryview:
+            return render_docx_fast(skeleton_zip, fast_parts, context)
+        return render_fast
+
+    base_tpl = DocxTemplate(io.BytesIO(template_bytes))
+    try:
+        import jinja2
+        with zipfile.ZipFile(io.BytesIO(template_bytes)) as z:
+            text_names = [n for n in z.namelist() if TEXT_PART_RE.match(n)]
+            compiled = {
+                n: jinja2.Template(base_tpl.patch_xml(z.read(n).decode("utf-8")),
+                                   autoescape=False)
+                for n in text_names
+            }
+        skeleton_zip = build_skeleton_zip(template_bytes, set(text_names))
+
+        def render_jinja(context: dict) -> memoryview:
+            buf = io.BytesIO(skeleton_zip)
+            with ZipFile(buf, "a", compression=zipfile.ZIP_DEFLATED) as zout:
+                for name, tmpl in compiled.items():
+                    zout.writestr(name, tmpl.render(context))
+            return buf.getbuffer()
+
+        return render_jinja
+    except Exception:
+        # Si el parchado/compilado no funciona con este machote, el camino
+        # docxtpl clásico sigue siendo el que manda
+        pass
+
+    base_docx = copy.deepcopy(base_tpl.docx)
+    # El renderer puede quedar compartido entre sesiones vía
+    # st.cache_resource y este camino muta base_tpl en cada render:
+    # sin candado, dos hilos generando a la vez corrompen el documento
+    render_lock = threading.Lock()
+
+    def render(context: dict) -> memoryview:
+        with render_lock:
+            base_tpl.docx = copy.deepcopy(base_docx)
+            base_tpl.render(context)
+            out = io.BytesIO()
+            base_tpl.save(out)
+            return out.getbuffer()
+
+    return render
+
+def _ws_to_df(ws) -> pd.DataFrame:
+    """Convierte una hoja read-only de openpyxl en DataFrame de strings."""
+    rows = ws.iter_rows(values_only=True)
+    headers = ["" if h is None else str(h) for h in next(rows, ())]
+    # Celdas de encabezado vacías como las nombra pd.read_excel
+    # (Unnamed: 0, ...): con "" tal cual, la columna queda inmapeable y
+    # pisa la opción vacía de los selectbox de mapeo
+    headers = [h if h != "" else f"Unnamed: {i}" for i, h in enumerate(headers)]
+    # Encabezados repetidos como los desambigua pd.read_excel (Nombre,
+    # Nombre.1, ...): con duplicados tal cual, df[col] devuelve un
+    # DataFrame y los lookups por posición colapsan columnas
+    seen = {}
+    for i, h in enumerate(headers):
+        if h in seen:
+            seen[h] += 1
+            new = f"{h}.{seen[h]}"
+            while new in seen:
+                seen[h] += 1
+                new = f"{h}.{seen[h]}"
+            headers[i] = new
+            seen[new] = 0
+        else:
+            seen[h] = 0
+    ncols = len(headers)
+    data = []
+    for r in rows:
+        vals = ["" if v is None else str(v) for v in r[:ncols]]
+        vals += [""] * (ncols - len(vals))
+        data.append(vals)
+    return pd.DataFrame(data, columns=headers, dtype=str).fillna("")
+
+@st.cache_data(show_spinner=False)
+def load_excel(xls_bytes: bytes) -> dict:
+    """Desempaqueta TODO el libro una sola vez: {hoja: DataFrame}.
+
+    Streamlit re-ejecuta el script completo en cada interacción; con el
+    cache (clave = bytes del archivo), cambiar un widget ya no vuelve a
+    decodificar el XLSX. openpyxl va en modo read-only (el loader por
+    defecto construye objetos de celda para toda la hoja); para .xls u
+    otros formatos que no maneja se cae a pd.read_excel."""
+    bio = io.BytesIO(xls_bytes)
+    try:
+        wb = openpyxl.load_workbook(bio, read_only=True, data_only=True)
+    except Exception:
+        bio.seek(0)
+        sheets = pd.read_excel(bio, sheet_name=None, dtype=str)
+        return {name: df.fillna("") for name, df in sheets.items()}
+    try:
+        return {name: _ws_to_df(wb[name]) for name in wb.sheetnames}
+    finally:
+        wb.close()
+
+def build_context_plan(valid_mappings: list, columns) -> list:
+    """Precalcula (placeholder, posición de columna, default) UNA vez por lote.
+
+    Saca del bucle caliente los accesos repetidos a los dicts de mapeo y la
+    resolución de nombres de columna: por fila queda solo indexar la tupla."""
+    col_pos = {c: i for i, c in enumerate(columns)}
+    return [(m["placeholder"],
+             col_pos.get(m["column"]) if m["column"] else None,
+             m["default"])
+            for m in valid_mappings]
+
+def build_context(plan: list, row_tup: tuple) -> dict:
+    """Contexto EXACTO tal como el Word espera (acentos/may/min intactos).
+
+    load_excel ya garantiza que toda celda es str ("" si estaba vacía), así
+    que aquí no hace falta pd.isna por celda: solo comparar contra ""."""
+    ctx = {}
+    for key, pos, default in plan:
+        if pos is not None:
+            val = row_tup[pos]
+            if val == "":
+                val = default
+        else:
+            val = default
+        ctx[key] = "" if val is None else val
+    return ctx
+
+# Mínimo de filas para que valga la pena pagar el fork de procesos
+MIN_ROWS_PARALLEL = 8
+
+_worker_render = None
+
+def _init_render_worker(template_bytes: bytes):
+    """Inicializa el renderer UNA vez por proceso hijo (evita re-picklear
+    el machote en cada tarea)."""
+    global _worker_render
+    _worker_render = make_docx_renderer(template_bytes)
+
+def _render_row_worker(task):
+    out_name, ctx = task
+    # bytes() explícito: el memoryview del renderer no se puede picklear
+    return out_name, bytes(_worker_render(ctx))
+
+# Fecha fija para las entradas del ZIP de salida: writestr con nombre
+# llama time.localtime() y normaliza el timestamp por cada entrada
+_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+def _zip_entry(name: str) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(name, date_time=_ZIP_DATE)
+    zinfo.compress_type = zipfile.ZIP_STORED
+    return zinfo
+
+@st.cache_resource(show_spinner=False)
+def _get_renderer_cached(tpl_hash: str):
+    # Los bytes del machote viven en session_state; el hash sha1 es la
+    # clave barata del cache (hashear los bytes completos por fila no)
+    return make_docx_renderer(st.session_state.tpl_bytes)
+
+@st.cache_data(max_entries=5000, show_spinner=False)
+def _render_row_cached(tpl_hash: str, ctx_items: tuple) -> bytes:
+    """Render de UNA fila cacheado por (machote, contexto).
+
+    Streamlit re-ejecuta todo en cada interacción: si el usuario vuelve a
+    generar tras tocar un widget que no cambia los datos, las filas ya
+    renderizadas salen del cache en vez de renderizarse otra vez."""
+    return bytes(_get_renderer_cached(tpl_hash)(dict(ctx_items)))
+
+def render_tasks_to_zip(zf: ZipFile, tpl_bytes: bytes, tasks: list):
+    """Renderiza [(nombre, contexto), ...] y escribe cada DOCX en `zf`.
+
+    El render es CPU-bound (lxml/Jinja o deflate), así que con suficientes
+    filas se reparte entre procesos; el ZIP de salida se escribe siempre
+    desde el proceso principal. Requiere "fork" para que los hijos no
+    re-ejecuten el script de Streamlit al importar el módulo.
+    """
+    if len(tasks) >= MIN_ROWS_PARALLEL and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_render_worker,
+            initargs=(tpl_bytes,),
+        ) as ex:
+            for out_name, out_bytes in ex.map(_render_row_worker, tasks, chunksize=16):
+                zf.writestr(_zip_entry(out_name), out_bytes)
+    else:
+        tpl_hash = hashlib.sha1(tpl_bytes).hexdigest()
+        for out_name, ctx in tasks:
+            zf.writestr(_zip_entry(out_name), _render_row_cached(tpl_hash, tuple(sorted(ctx.items()))))
 
-PLACEHOLDER_RE = re.compile(r"{{\s*([^{}}]+?)\s*}}")
+# ============== Detección (best effort, opcional) ==============
 
+# google-re2 (opcional): motor DFA varias veces más rápido que `re` sobre
+# XML grande, con el mismo API para este patrón. Sin él, `re` normal.
+try:
+    import re2 as _re_engine
+except ImportError:
+    _re_engine = re
+
+PLACEHOLDER_RE = _re_engine.compile(r"{{\s*([^{}}]+?)\s*}}")
+
+_SCAN_CHUNK = 64 * 1024
+_SCAN_TAIL = 256  # > placeholder más largo admitido (80) con llaves y espacios
+
+def scan_placeholders_stream(z: zipfile.ZipFile, part: str, found: set):
+    """Escanea `{{...}}` leyendo la entrada del ZIP en trozos de 64 KiB.
+
+    No materializa el XML descomprimido completo: arrastra una cola de
+    _SCAN_TAIL bytes entre trozos para no perder coincidencias que caigan
+    justo en la frontera. La memoria pico queda acotada sin importar el
+    tamaño de document.xml."""
+    tail = b""
+    with z.open(part) as f:
+        while True:
+            chunk = f.read(_SCAN_CHUNK)
+            if not chunk:
+                break
+            window = tail + chunk
+            for m in PLACEHOLDER_RE.finditer(window.decode("utf-8", errors="ignore")):
+                found.add(m.group(1).strip())
+            tail = window[-_SCAN_TAIL:]
+
+@st.cache_data(show_spinner=False, max_entries=4)
 def extract_placeholders_best_effort(docx_bytes: bytes):
     """
     Devuelve una lista *posible* de placeholders leyendo el XML.
+    Cacheado por bytes del machote: cada rerun de Streamlit lo re-llamaba
+    aunque el archivo no hubiera cambiado.
     OJO: Word a veces parte las llaves en "runs" y no aparecen completas.
     Igual usamos esto SOLO para sugerir; el usuario puede añadir manualmente.
     """
     placeholders = set()
     try:
         with zipfile.ZipFile(io.BytesIO(docx_bytes), "r") as z:
-            for name in z.namelist():
-                if name.startswith("word/") and name.endswith(".xml"):
-                    xml = z.read(name).decode("utf-8", errors="ignore")
-                    for m in PLACEHOLDER_RE.findall(xml):
-                        placeholders.add(m.strip())
+            # Solo las partes con contenido: styles/numbering/theme/settings
+            # nunca traen placeholders y escanearlas es puro desperdicio
+            names = z.namelist()
+            xml_names = [n for n in names if n == "word/document.xml"]
+            xml_names += [n for n in names
+                          if n.startswith(("word/header", "word/footer", "word/footnotes",
+                                           "word/endnotes", "word/comments"))
+                          and n.endswith(".xml")]
+            for name in xml_names:
+                scan_placeholders_stream(z, name, placeholders)
     except Exception:
         pass
     # Filtra cosas raras (líneas muy largas)
@@ -119,12 +523,22 @@ with col1:
     tpl_file = st.file_uploader("Sube el machote (.docx)", type=["docx"])
     xls_file = st.file_uploader("Sube el Excel de datos", type=["xlsx", "xls"])
 
+# Bytes de las subidas UNA vez por archivo: leer el uploader en cada rerun
+# re-copia el buffer completo aunque el archivo no haya cambiado
+if tpl_file and st.session_state.get("tpl_file_id") != tpl_file.file_id:
+    st.session_state.tpl_bytes = tpl_file.getvalue()
+    st.session_state.tpl_file_id = tpl_file.file_id
+if xls_file and st.session_state.get("xls_file_id") != xls_file.file_id:
+    st.session_state.xls_bytes = xls_file.getvalue()
+    st.session_state.xls_file_id = xls_file.file_id
+
 with col2:
     sheet_name = None
+    dfs = None
     if xls_file:
         try:
-            x = pd.ExcelFile(xls_file)
-            sheet_name = st.selectbox("Hoja del Excel", x.sheet_names, index=0)
+            dfs = load_excel(st.session_state.xls_bytes)
+            sheet_name = st.selectbox("Hoja del Excel", list(dfs), index=0)
         except Exception as e:
             st.error(f"No se pudo leer el Excel: {e}")
 
@@ -134,9 +548,9 @@ if "mappings" not in st.session_state:
     st.session_state.mappings = []   # cada item: {"placeholder":"Cédula", "column":"Cédula", "default":""}
 
 if tpl_file and xls_file and sheet_name:
-    # --- Leer Excel ---
+    # --- Leer Excel (ya desempacado y cacheado) ---
     try:
-        df = pd.read_excel(xls_file, sheet_name=sheet_name, dtype=str).fillna("")
+        df = dfs[sheet_name]
     except Exception as e:
         st.error(f"Error leyendo la hoja '{sheet_name}': {e}")
         st.stop()
@@ -144,12 +558,16 @@ if tpl_file and xls_file and sheet_name:
     # Columnas originales y normalizadas (para sugerencias sólidas)
     cols_original = list(df.columns)
     cols_norm_map = {c: normalize_key(c) for c in cols_original}
+    # Índice precalculado para los selectbox: list.index() era O(columnas)
+    # por mapeo en cada rerun de Streamlit
+    col_options = [""] + cols_original
+    col_index = {name: i for i, name in enumerate(col_options)}
 
     st.subheader("🧾 Columnas del Excel")
     st.write(", ".join(map(str, cols_original)))
 
     # --- Leer placeholders sugeridos del Word (solo para ayudar) ---
-    tpl_bytes = tpl_file.read()
+    tpl_bytes = st.session_state.tpl_bytes
     suggested_placeholders = extract_placeholders_best_effort(tpl_bytes)
     if suggested_placeholders:
         st.subheader("🔎 Placeholders detectados (sugerencias)")
@@ -194,7 +612,7 @@ if tpl_file and xls_file and sheet_name:
         st.markdown(f"**Mapeo {idx+1}**")
         col_a, col_b, col_c, col_d = st.columns([2, 2, 2, 1])
         placeholder = col_a.text_input("Placeholder (tal como en el Word, sin llaves)", value=m["placeholder"], key=f"ph_{idx}")
-        column = col_b.selectbox("Columna del Excel", options=[""] + cols_original, index=([""] + cols_original).index(m["column"]) if m["column"] in cols_original else 0, key=f"col_{idx}")
+        column = col_b.selectbox("Columna del Excel", options=col_options, index=col_index.get(m["column"], 0), key=f"col_{idx}")
         default = col_c.text_input("Valor por defecto (si la celda está vacía)", value=m["default"], key=f"def_{idx}")
         remove = col_d.checkbox("Eliminar", value=False, key=f"rm_{idx}")
 
@@ -209,9 +627,10 @@ if tpl_file and xls_file and sheet_name:
     st.subheader("👤 Columna para el **nombre del archivo**")
     # Sugerimos por nombres típicos
     candidatos_nombre = ["NOMBRE", "NOMBRE COMPLETO", "NOMBRE Y APELLIDO", "ALUMNO", "ESTUDIANTE", "PARTICIPANTE", "NAME", "FULL NAME"]
+    candidatos_nombre_norm = {normalize_key(x) for x in candidatos_nombre}
     auto_idx = 0
     for i, c in enumerate(cols_original):
-        if cols_norm_map[c] in [normalize_key(x) for x in candidatos_nombre]:
+        if cols_norm_map[c] in candidatos_nombre_norm:
             auto_idx = i
             break
     nombre_col_original = st.selectbox("Selecciona la columna que contiene el nombre de la persona", options=cols_original, index=auto_idx)
@@ -228,34 +647,33 @@ if tpl_file and xls_file and sheet_name:
     with c1:
         if st.button("⬇️ Generar ZIP de DOCX", type="primary", disabled=(len(valid_mappings) == 0)):
             with st.spinner("Generando documentos DOCX..."):
-                memory_zip = io.BytesIO()
-                with ZipFile(memory_zip, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                    for i in range(len(df)):
-                        # Construir contexto EXACTO tal como el Word espera
-                        ctx = {}
-                        for m in valid_mappings:
-                            key = m["placeholder"]  # EXACTO como en Word (con acentos/may/min)
-                            if m["column"]:
-                                val = df.iloc[i][m["column"]]
-                                if pd.isna(val) or val == "":
-                                    val = m["default"]
-                            else:
-                                val = m["default"]
-                            ctx[key] = "" if val is None else val
-
-                        # Render y escribir
-                        out_bytes = render_docx_from_template(tpl_bytes, ctx)
-
-                        # Nombre de archivo
-                        base_name_val = df.iloc[i][nombre_col_original]
-                        base_name_val = sanitize_filename(base_name_val) if base_name_val else f"documento_{i+1}"
-                        out_name = f"{base_name_val} - Certificado.docx"
-                        zf.writestr(out_name, out_bytes)
-
-                memory_zip.seek(0)
+                plan = build_context_plan(valid_mappings, cols_original)
+                base_names = sanitize_filenames(df[nombre_col_original])
+                tasks = []
+                # itertuples entrega tuplas planas a velocidad C; df.iloc[i]
+                # construía una Series nueva por fila
+                for i, row_tup in enumerate(df.itertuples(index=False, name=None)):
+                    ctx = build_context(plan, row_tup)
+                    tasks.append((f"{base_names[i]} - Certificado.docx", ctx))
+
+                # Spooled mientras se arma: hasta 64 MB queda en RAM, más
+                # allá se derrama a disco solo (y no deja archivos huérfanos
+                # con nombre). ZIP_STORED porque los DOCX ya vienen
+                # deflateados por dentro: re-comprimirlos gasta CPU para
+                # ~0% de ganancia. download_button solo acepta str/bytes o
+                # los file-like de su lista blanca, así que al final se le
+                # entregan los bytes y se cierra el spool.
+                zip_out = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, suffix=".zip")
+                with ZipFile(zip_out, "w", compression=zipfile.ZIP_STORED,
+                             allowZip64=True) as zf:
+                    render_tasks_to_zip(zf, tpl_bytes, tasks)
+
+                zip_out.seek(0)
+                zip_bytes = zip_out.read()
+                zip_out.close()
             st.download_button(
                 "Descargar DOCX.zip",
-                data=memory_zip,
+                data=zip_bytes,
                 file_name="certificados_docx.zip",
                 mime="application/zip"
             )
@@ -271,50 +689,43 @@ if tpl_file and xls_file and sheet_name:
 
         if pdf_btn:
             with st.spinner("Generando documentos PDF..."):
-                tempdir = tempfile.TemporaryDirectory()
+                tpl_hash = hashlib.sha1(tpl_bytes).hexdigest()
+                # /dev/shm (tmpfs) en Linux: los DOCX/PDF intermedios viven
+                # en RAM y nunca tocan el disco; soffice ve rutas normales
+                tempdir = tempfile.TemporaryDirectory(
+                    dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
                 outdir = Path(tempdir.name)
-                pdf_zip = io.BytesIO()
+                pdf_zip = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, suffix=".zip")
 
+                plan = build_context_plan(valid_mappings, cols_original)
+                base_names = sanitize_filenames(df[nombre_col_original])
                 docx_paths = []
-                for i in range(len(df)):
-                    ctx = {}
-                    for m in valid_mappings:
-                        key = m["placeholder"]
-                        if m["column"]:
-                            val = df.iloc[i][m["column"]]
-                            if pd.isna(val) or val == "":
-                                val = m["default"]
-                        else:
-                            val = m["default"]
-                        ctx[key] = "" if val is None else val
-
-                    base_name_val = df.iloc[i][nombre_col_original]
-                    base_name_val = sanitize_filename(base_name_val) if base_name_val else f"documento_{i+1}"
-                    docx_path = outdir / f"{base_name_val} - Certificado.docx"
+                for i, row_tup in enumerate(df.itertuples(index=False, name=None)):
+                    ctx = build_context(plan, row_tup)
+                    docx_path = outdir / f"{base_names[i]} - Certificado.docx"
 
                     # Render a disco
-                    doc_bytes = render_docx_from_template(tpl_bytes, ctx)
+                    doc_bytes = _render_row_cached(tpl_hash, tuple(sorted(ctx.items())))
                     docx_path.write_bytes(doc_bytes)
                     docx_paths.append(docx_path)
 
-                # Convertir cada DOCX a PDF
-                pdf_paths = []
-                for docx_path in docx_paths:
-                    pdf_path = docx_path.with_suffix(".pdf")
-                    ok = try_docx_to_pdf(docx_path, pdf_path)
-                    if ok and pdf_path.exists():
-                        pdf_paths.append(pdf_path)
+                # Convertir todos los DOCX a PDF (en lote si hay soffice)
+                pdf_paths = try_docx_to_pdf_batch(docx_paths, outdir)
 
                 if not pdf_paths:
                     st.error("No se pudieron generar PDFs. Verifica que Word/LibreOffice estén instalados.")
                 else:
-                    with ZipFile(pdf_zip, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                    with ZipFile(pdf_zip, "w", compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=1, allowZip64=True,
+                                 strict_timestamps=False) as zf:
                         for p in pdf_paths:
                             zf.write(p, arcname=p.name)
                     pdf_zip.seek(0)
+                    pdf_bytes = pdf_zip.read()
+                    pdf_zip.close()
                     st.download_button(
                         "Descargar PDF.zip",
-                        data=pdf_zip,
+                        data=pdf_bytes,
                         file_name="certificados_pdf.zip",
                         mime="application/zip"
                     )